@@ -1,134 +1,339 @@
 """Rangetrees are binary trees for fast lookups in ranges."""
-from enum import Enum, unique
-from typing import Union, TypeVar, Generic
+import math
+from bisect import bisect_right
+from typing import Union, TypeVar, Generic, Iterable, List, Optional, Tuple
 
-from bintrees import FastAVLTree
+from sortedcontainers import SortedDict
 
 V = TypeVar('V')
 D = TypeVar('D')
+Num = Union[int, float]  # Interval bounds, possibly +-math.inf
 
+# Open bounds, bound once instead of looked up on every use.
+_INF_PLUS = math.inf
+_INF_MINUS = -math.inf
 
-@unique
-class InfinityMarker(Enum):
-    INF_PLUS = "inf_plus"
-    INF_MINUS = "inf_minus"
+
+def _encode(key: Union[slice, range]) -> Tuple[Num, Num]:
+    """Turn a slice or range into a (start, end) pair, with start <= end.
+
+    Open bounds are encoded as -math.inf and math.inf.
+    """
+    if isinstance(key, (slice, range)):
+        if key.step is not None and key.step != 1:
+            m = 'Intervals with custom steps ({}) not' \
+                ' supported.'.format(key)
+            raise ValueError(m)
+    else:
+        raise ValueError('Only slices and ranges supported.')
+    return _canonical(key.start, key.stop)
+
+
+def _canonical(start: Optional[int], stop: Optional[int]) -> Tuple[Num, Num]:
+    """Turn interval bounds into a (start, end) pair, with start <= end.
+
+    None bounds are encoded as -math.inf and math.inf.
+    """
+    if start is None:
+        start = _INF_MINUS
+    if stop is None:
+        stop = _INF_PLUS
+    if start > stop:
+        start, stop = stop, start
+    return start, stop
 
 
 class RangeTree(Generic[V]):
     """A specialized tree dealing with ranges."""
 
+    __slots__ = ('_ends', '_values', '_keys', '_flat', '__weakref__')
+
     def __init__(self) -> None:
-        self._tree = FastAVLTree()  # Map ints to tuples (val, Union[end, InfinityMarker])
+        # Interval ends and values are kept apart, both keyed by the
+        # interval start. Open intervals use math.inf as their end, or
+        # -math.inf as their start.
+        self._ends = SortedDict()  # Map Nums to Nums
+        self._values = {}  # Map Nums to values
+        self._keys = self._ends.keys()
+        # Flat (starts, ends, values) lists for batch lookups; rebuilt
+        # lazily after the tree changes.
+        self._flat = None
+
+    @classmethod
+    def from_sorted(cls, intervals: Iterable[Tuple[Optional[int],
+                                                   Optional[int], V]]
+                    ) -> 'RangeTree[V]':
+        """Build a RangeTree from (start, stop, value) triples.
+
+        This is much faster than adding the intervals one by one. The
+        intervals are sorted by start first, which is cheapest if they
+        already are. None marks an open end, as in add_interval().
+
+        Empty intervals are ignored, as in add_interval(). Overlapping
+        intervals will raise a KeyError.
+        """
+        items = []
+        for start, stop, value in intervals:
+            start, stop = _canonical(start, stop)
+            if start != stop:
+                items.append((start, stop, value))
+        items.sort(key=lambda i: i[0])
+
+        # A single pass suffices to check for overlaps between neighbours.
+        starts, ends, values = [], [], []
+        for start, stop, value in items:
+            if ends and start < ends[-1]:
+                raise KeyError('Overlapping intervals.')
+            starts.append(start)
+            ends.append(stop)
+            values.append(value)
+
+        tree = cls()
+        tree._ends.update(zip(starts, ends))
+        tree._values.update(zip(starts, values))
+        tree._flat = ([_INF_MINUS] + starts, [_INF_MINUS] + ends,
+                      [None] + values)
+        return tree
+
+    def _flatten(self):
+        """Get the intervals as parallel (starts, ends, values) lists.
+
+        The lists begin with an empty [-inf, -inf) sentinel interval, so
+        bisecting any key lands on a valid index and a lookup needs just
+        the key < end check.
+        """
+        if self._flat is None:
+            keys = list(self._keys)
+            values = self._values
+            self._flat = ([_INF_MINUS] + keys,
+                          [_INF_MINUS] + list(self._ends.values()),
+                          [None] + [values[s] for s in keys])
+        return self._flat
 
     def __setitem__(self, key: Union[slice, range], value: V) -> None:
         """Set a value to the given interval.
 
         If the interval is already occupied, a ValueError will be thrown.
 
+        Empty intervals ([1:1]) contain no keys, and are ignored.
+
         Only slices and ranges with the default step (1) are supported.
 
         If the slice or range is inverted (end < start), the interval will be
         flipped.
 
         Open slices and ranges ([:1], [1:]) are supported.
+
+        Frozen trees cannot be modified, and will raise a TypeError.
         """
-        if isinstance(key, (slice, range)):
-            if key.step is not None and key.step != 1:
-                m = 'Intervals with custom steps ({}) not' \
-                    ' supported.'.format(key)
-                raise ValueError(m)
-        else:
-            raise ValueError('Only slices and ranges supported.')
-        s, e = key.start, key.stop
-        if s is not None and e is not None and s > e:
-            s, e = e, s
-
-        # The check for an empty space is a little complex.
-        # First check the lower bound.
-        anchor = s if s is not None else e - 1
-        try:
-            lower_item = self._tree.floor_item(anchor)
-        except KeyError:
-            lower_item = None
-        if lower_item is not None:
-            if (s is None or
-                lower_item[1][1] is InfinityMarker.INF_PLUS or
-                (lower_item[1][1] is not InfinityMarker.INF_MINUS and
-                 lower_item[1][1] > s)):
-                raise KeyError('Overlapping intervals.')
+        s, e = _encode(key)
+        self._insert(s, e, value)
+
+    def add_interval(self, start: Optional[int], stop: Optional[int],
+                     value: V) -> None:
+        """Set a value to the interval [start, stop).
+
+        Works like setting a slice, without the slice handling overhead.
+        A start or stop of None makes the interval open on that side.
+        """
+        s, e = _canonical(start, stop)
+        self._insert(s, e, value)
 
-        # Now the higher bound.
-        try:
-            higher_item = self._tree.ceiling_item(anchor)
-        except KeyError:
-            higher_item = None
-        if higher_item is not None:
-            if e is None or higher_item[1][1] is InfinityMarker.INF_MINUS or higher_item[0] < e:
-                raise KeyError('Overlapping intervals')
+    def _insert(self, s: Num, e: Num, value: V) -> None:
+        """Set a value to the canonical interval [s, e)."""
+        if s == e:
+            # Empty intervals contain no keys, and are not stored.
+            return
+        # Neighbouring intervals may touch us, but not overlap. Both are
+        # found with a single search.
+        ends = self._ends
+        idx = self._ends.bisect_right(s)
+        if idx and ends[self._keys[idx - 1]] > s:
+            raise KeyError('Overlapping intervals.')
+        if idx < len(ends) and self._keys[idx] < e:
+            raise KeyError('Overlapping intervals.')
 
-        if e is None:
-            e = InfinityMarker.INF_PLUS
-        elif s is None:
-            e = InfinityMarker.INF_MINUS
+        ends[s] = e
+        self._values[s] = value
+        self._flat = None
 
-        self._tree[anchor] = (value, e)
+    def freeze(self) -> None:
+        """Make the tree read-only, speeding up lookups.
+
+        Frozen trees answer lookups from flat sorted lists instead of
+        walking the tree, which is released to save memory.
+        """
+        self._flatten()
+        self._ends.clear()
+        self._values.clear()
+        self.__class__ = _FrozenRangeTree
 
     def __getitem__(self, key: int) -> V:
-        try:
-            res = self._tree.floor_item(key)
-        except KeyError:
-            res = self._tree.ceiling_item(key)
-            val, e = res[1]
-            if e is InfinityMarker.INF_MINUS:
-                return val
-            else:
-                raise KeyError(key)
-
-        val, e = res[1]
-        if (e is InfinityMarker.INF_PLUS or
-            (e is InfinityMarker.INF_MINUS and res[0] == key) or
-            (e is not InfinityMarker.INF_MINUS and key < e)):
-            return val
-        else:
-            raise KeyError(key)
+        idx = self._ends.bisect_right(key)
+        if idx:
+            start = self._keys[idx - 1]
+            if key < self._ends[start]:
+                return self._values[start]
+        raise KeyError(key)
 
     def get(self, key, default: D=None) -> Union[V, D]:
-        try:
-            res = self._tree.floor_item(key)
-        except KeyError:
-            try:
-                res = self._tree.ceiling_item(key)
-            except KeyError:
-                return default
-            val, e = res[1]
-            if e is InfinityMarker.INF_MINUS:
-                return val
+        idx = self._ends.bisect_right(key)
+        if idx:
+            start = self._keys[idx - 1]
+            if key < self._ends[start]:
+                return self._values[start]
+        return default
+
+    def lookup(self, keys: Iterable[int], default: D=None) -> List[Union[V, D]]:
+        """Look up many keys at once.
+
+        Returns a list with the value for each key, in order, or the
+        default for keys not in any interval.
+
+        Lookups are answered from flat copies of the intervals. The first
+        lookup() after the tree changes rebuilds them in O(n), and they
+        are kept in memory until the next change. This is cheaper than
+        calling get() in a loop only when the tree isn't modified between
+        calls, or the batch is large.
+        """
+        starts, ends, values = self._flatten()
+        res = []
+        append = res.append
+        for key in keys:
+            idx = bisect_right(starts, key) - 1
+            if key < ends[idx]:
+                append(values[idx])
             else:
-                return default
-
-        val, e = res[1]
-        if (e is InfinityMarker.INF_PLUS or
-                (e is InfinityMarker.INF_MINUS and res[0] == key) or
-                (e is not InfinityMarker.INF_MINUS and key < e)):
-            return val
-        else:
+                append(default)
+        return res
+
+    def __contains__(self, key: int) -> bool:
+        # Only the ends are needed here, never the values.
+        idx = self._ends.bisect_right(key)
+        return idx > 0 and key < self._ends[self._keys[idx - 1]]
+
+
+class _FrozenRangeTree(RangeTree[V]):
+    """A RangeTree after freeze(), specialized for lookups.
+
+    freeze() switches the class of the frozen instance to this one, so
+    neither frozen nor regular lookups need to check for frozenness.
+    """
+
+    __slots__ = ()
+
+    def _insert(self, s: Num, e: Num, value: V) -> None:
+        raise TypeError('Frozen RangeTrees cannot be modified.')
+
+    def freeze(self) -> None:
+        pass
+
+    def __getitem__(self, key: int) -> V:
+        starts, ends, values = self._flat
+        idx = bisect_right(starts, key) - 1
+        if key < ends[idx]:
+            return values[idx]
+        raise KeyError(key)
+
+    def get(self, key, default: D=None) -> Union[V, D]:
+        starts, ends, values = self._flat
+        idx = bisect_right(starts, key) - 1
+        if key < ends[idx]:
+            return values[idx]
+        return default
+
+    def __contains__(self, key: int) -> bool:
+        starts, ends, _ = self._flat
+        return key < ends[bisect_right(starts, key) - 1]
+
+
+class AugmentedRangeTree(Generic[V]):
+    """A static tree of possibly overlapping ranges.
+
+    The tree is built once from an iterable of (slice or range, value)
+    pairs, and looking up a key returns the values of all ranges
+    containing it, ordered by range start.
+
+    Ranges are kept sorted by start in flat lists, forming an implicit
+    balanced binary tree: the root of any [lo, hi) slice of the lists
+    is at its midpoint. Each node also records the greatest end in its
+    subtree, so lookups skip subtrees that end before the key.
+    """
+
+    __slots__ = ('_starts', '_ends', '_values', '_max_ends', '__weakref__')
+
+    def __init__(self, items: Iterable[Tuple[Union[slice, range], V]]) -> None:
+        intervals = [_encode(key) + (value, ) for key, value in items]
+        intervals.sort(key=lambda i: (i[0], i[1]))
+        self._starts = [i[0] for i in intervals]
+        self._ends = [i[1] for i in intervals]
+        self._values = [i[2] for i in intervals]
+        self._max_ends = list(self._ends)
+        if intervals:
+            self._build(0, len(intervals))
+
+    def _build(self, lo: int, hi: int) -> Num:
+        """Fill in the greatest subtree ends for [lo, hi), returning its own."""
+        mid = (lo + hi) // 2
+        max_end = self._max_ends[mid]
+        if lo < mid:
+            max_end = max(max_end, self._build(lo, mid))
+        if mid + 1 < hi:
+            max_end = max(max_end, self._build(mid + 1, hi))
+        self._max_ends[mid] = max_end
+        return max_end
+
+    def _find(self, key: int) -> List[int]:
+        """Get the sorted indices of all ranges containing the key."""
+        starts, ends, max_ends = self._starts, self._ends, self._max_ends
+        res = []
+        stack = [(0, len(starts))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if max_ends[mid] <= key:
+                continue
+            stack.append((lo, mid))
+            if starts[mid] <= key:
+                if key < ends[mid]:
+                    res.append(mid)
+                stack.append((mid + 1, hi))
+        res.sort()
+        return res
+
+    def __getitem__(self, key: int) -> List[V]:
+        res = self._find(key)
+        if not res:
+            raise KeyError(key)
+        values = self._values
+        return [values[i] for i in res]
+
+    def get(self, key, default: D=None) -> Union[List[V], D]:
+        res = self._find(key)
+        if not res:
             return default
+        values = self._values
+        return [values[i] for i in res]
 
     def __contains__(self, key: int) -> bool:
-        try:
-            existing = self._tree.floor_item(key)
-        except KeyError:
-            try:
-                existing = self._tree.ceiling_item(key)
-            except KeyError:
+        # Any containing range will do, so a single descent suffices. If the
+        # left subtree has a range ending after the key, it holds a match
+        # whenever there is one: its starts are <= ours, and the right
+        # subtree's starts are >= ours.
+        starts, ends, max_ends = self._starts, self._ends, self._max_ends
+        lo, hi = 0, len(starts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if max_ends[mid] <= key:
                 return False
-            else:
-                return existing[1][1] is InfinityMarker.INF_MINUS
-        else:
-            start, (_, end) = existing
-            if end is InfinityMarker.INF_MINUS:
-                return start == key
-            elif end is InfinityMarker.INF_PLUS:
+            if starts[mid] <= key < ends[mid]:
                 return True
+            if lo < mid and max_ends[(lo + mid) // 2] > key:
+                hi = mid
+            elif starts[mid] <= key:
+                lo = mid + 1
             else:
-                return key < end
+                return False
+        return False
@@ -23,6 +23,6 @@ setup(
         "Programming Language :: Python :: 3.5",
     ],
     install_requires=[
-        'bintrees',
+        'sortedcontainers',
     ],
 )
@@ -1,13 +1,16 @@
 """Tests for the rangetree module"""
+import copy
+import pickle
+import weakref
 from collections import defaultdict
 
 import pytest
-from hypothesis import assume
+from hypothesis import assume, given
 from hypothesis.stateful import (RuleBasedStateMachine,
                                  run_state_machine_as_test, rule, precondition)
 from hypothesis.strategies import (integers, tuples, just, sampled_from,
-                                   one_of, text, data)
-from rangetree import RangeTree
+                                   one_of, text, data, lists)
+from rangetree import RangeTree, AugmentedRangeTree
 
 
 def test_rangetree_stateful():
@@ -29,27 +32,37 @@ def test_rangetree_stateful():
             self.inf_plus = []
             self.inf_minus = []
 
-        @rule(r=inf_ranges, val=integers())
-        def add_open_interval(self, r, val):
+        @rule(r=inf_ranges, val=integers(),
+              type_=sampled_from(['slice', 'add_interval']))
+        def add_open_interval(self, r, val, type_):
             anchor, direction = r
             try:
                 if direction == '+':
-                    self.rt[anchor:] = val
+                    if type_ == 'slice':
+                        self.rt[anchor:] = val
+                    else:
+                        self.rt.add_interval(anchor, None, val)
                     self.inf_plus.append(anchor)
                 else:
-                    self.rt[:anchor] = val
+                    if type_ == 'slice':
+                        self.rt[:anchor] = val
+                    else:
+                        self.rt.add_interval(None, anchor, val)
                     self.inf_minus.append(anchor - 1)
             except Exception:
                 pass
 
-        @rule(r=all_ranges, val=integers(), type_=sampled_from(['slice', 'range']))
+        @rule(r=all_ranges, val=integers(),
+              type_=sampled_from(['slice', 'range', 'add_interval']))
         def add_interval(self, r, val, type_):
             """Add a range or slice to a rangetree."""
             try:
                 if type_ == 'slice':
                     self.rt[r[0]:r[1]] = val
-                else:
+                elif type_ == 'range':
                     self.rt[range(*r)] = val
+                else:
+                    self.rt.add_interval(r[0], r[1], val)
             except KeyError:
                 pass
             else:
@@ -106,6 +119,12 @@ def test_rangetree_stateful():
                 assert self.rt[k] == v[0]
                 assert self.rt.get(k) == v[0]
 
+        @rule(keys=lists(integers()))
+        def assert_lookup_matches_get(self, keys):
+            keys += list(self.oracle)
+            o = object()
+            assert self.rt.lookup(keys, o) == [self.rt.get(k, o) for k in keys]
+
         @rule(data=data())
         @precondition(lambda self: self.inf_plus and not self.oracle)
         def assert_open_overlap_plus_contains(self, data):
@@ -151,3 +170,127 @@ def test_rangetree_stateful():
             assert self.rt.get(value_out, -1) == -1
 
     run_state_machine_as_test(RangeTreeStateful)
+
+
+@given(intervals=lists(tuples(integers(), integers(), integers())),
+       keys=lists(integers()))
+def test_rangetree_frozen(intervals, keys):
+    """Frozen RangeTrees answer lookups like unfrozen ones."""
+    rt = RangeTree()
+    frozen = RangeTree()
+    for start, stop, val in intervals:
+        try:
+            rt[start:stop] = val
+        except KeyError:
+            continue
+        frozen[start:stop] = val
+    frozen.freeze()
+    assert not frozen._ends and not frozen._values
+
+    keys += [start for start, _, _ in intervals]
+    for key in keys:
+        assert (key in frozen) == (key in rt)
+        assert frozen.get(key) == rt.get(key)
+        if key in rt:
+            assert frozen[key] == rt[key]
+        else:
+            with pytest.raises(KeyError):
+                frozen[key]
+    assert frozen.lookup(keys) == rt.lookup(keys)
+
+    with pytest.raises(TypeError):
+        frozen[0:1] = 1
+    with pytest.raises(TypeError):
+        frozen.add_interval(0, 1, 1)
+
+
+@given(intervals=lists(tuples(integers(), integers(), integers())),
+       open_intervals=lists(tuples(integers(), sampled_from(['+', '-']),
+                                   integers())),
+       keys=lists(integers()))
+def test_augmented_rangetree(intervals, open_intervals, keys):
+    """AugmentedRangeTrees find every range containing a key."""
+    items = [(slice(s, e), v) for s, e, v in intervals]
+    items += [(slice(a, None) if d == '+' else slice(None, a), v)
+              for a, d, v in open_intervals]
+    rt = AugmentedRangeTree(items)
+
+    def contains(key, k):
+        s, e = k.start, k.stop
+        if s is not None and e is not None and s > e:
+            s, e = e, s
+        return (s is None or s <= key) and (e is None or key < e)
+
+    keys += [s for s, _, _ in intervals] + [a for a, _, _ in open_intervals]
+    for key in keys:
+        expected = sorted(v for k, v in items if contains(key, k))
+        if expected:
+            assert key in rt
+            assert sorted(rt[key]) == expected
+            assert sorted(rt.get(key)) == expected
+        else:
+            assert key not in rt
+            with pytest.raises(KeyError):
+                rt[key]
+            assert rt.get(key) is None
+
+
+@given(intervals=lists(tuples(one_of(integers(), just(None)),
+                              one_of(integers(), just(None)), integers())),
+       keys=lists(integers()))
+def test_rangetree_from_sorted(intervals, keys):
+    """RangeTree.from_sorted() builds the same tree as add_interval()."""
+    rt = RangeTree()
+    added = []
+    for start, stop, val in intervals:
+        try:
+            rt.add_interval(start, stop, val)
+        except KeyError:
+            continue
+        added.append((start, stop, val))
+
+    built = RangeTree.from_sorted(added)
+    keys += [start for start, _, _ in added if start is not None]
+    for key in keys:
+        assert built.get(key) == rt.get(key)
+    assert built.lookup(keys) == rt.lookup(keys)
+
+    if len(added) < len(intervals):
+        with pytest.raises(KeyError):
+            RangeTree.from_sorted(intervals)
+
+
+def test_rangetree_from_sorted_empty():
+    """RangeTree.from_sorted() ignores empty intervals, in any order."""
+    for intervals in ([(5, 10, 'f'), (5, 5, 'e')],
+                      [(5, 5, 'e'), (5, 10, 'f')],
+                      [(5, 10, 'f'), (7, 7, 'e')]):
+        rt = RangeTree.from_sorted(intervals)
+        assert rt[5] == 'f'
+        assert rt[7] == 'f'
+        assert 10 not in rt
+
+
+def test_weakrefs():
+    """Trees support weak references."""
+    rt = RangeTree()
+    assert weakref.ref(rt)() is rt
+    rt.freeze()
+    assert weakref.ref(rt)() is rt
+    art = AugmentedRangeTree([])
+    assert weakref.ref(art)() is art
+
+
+@pytest.mark.parametrize('clone', [copy.deepcopy,
+                                   lambda rt: pickle.loads(pickle.dumps(rt))])
+def test_clone_then_insert(clone):
+    """Copied and unpickled trees see later inserts."""
+    rt = RangeTree()
+    rt[0:10] = 1
+    c = clone(rt)
+    c[20:30] = 2
+    assert c.get(25) == 2
+    assert 25 in c
+    assert c[5] == 1
+    with pytest.raises(KeyError):
+        c[25:35] = 3